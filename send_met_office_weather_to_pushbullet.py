@@ -13,18 +13,76 @@ indicating in one line the likelihood that the weather is good - see
 function 'calc_nice_day_emoticon'
 
 The pushbullet and met office API keys PUSHBULLET_API_KEY and
-MET_OFFICE_API_KEY are set from environment variables
+MET_OFFICE_API_KEY are set from environment variables.
+
+Only the next MAX_WEATHER_TARGETS period 4/5 forecasts are sent, set from an
+environment variable. This defaults to 4, i.e. two days. Note the message used
+to cover the whole 5 day forecast; set MAX_WEATHER_TARGETS to 10 to get that
+back.
 """
 from pushbullet import Pushbullet
 import os
 import sys
-import requests
+import requests_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
+import bisect
+import itertools
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import pickle
+import tempfile
+import contextlib
+from typing import NamedTuple
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 """Pushbullet and Met Office API keys are set from environment variables
 """
 PUSHBULLET_API_KEY = os.environ['PUSHBULLET_API_KEY']
 MET_OFFICE_API_KEY = os.environ['MET_OFFICE_API_KEY']
+"""Number of period 4/5 forecasts to send (default the next 4, i.e. two days),
+set from an environment variable
+"""
+MAX_WEATHER_TARGETS = int(os.environ.get('MAX_WEATHER_TARGETS', 4))
+"""Directory the Met Office responses are cached in
+"""
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'met_office')
+"""The 3 hourly forecast is only updated a few times a day so cache the Met
+Office responses for an hour (or as long as the Cache-Control/Expires headers
+allow). If the Met Office can't be reached the stale response is used. The API
+key is left out of the cache key and isn't stored in the cache.
+"""
+MET_OFFICE_SESSION = requests_cache.CachedSession(
+    os.path.join(CACHE_DIR, 'http_cache'),
+    backend='sqlite',
+    expire_after=3600,
+    allowable_methods=('GET',),
+    stale_if_error=True,
+    cache_control=True,
+    ignored_parameters=['key'])
+"""Keep the connection to the Met Office open for reuse, retry failed
+connections with a backoff and don't wait forever for a response
+"""
+MET_OFFICE_ADAPTER = HTTPAdapter(pool_connections=2,
+                                 pool_maxsize=2,
+                                 max_retries=Retry(total=3,
+                                                   backoff_factor=0.3))
+MET_OFFICE_SESSION.mount('http://', MET_OFFICE_ADAPTER)
+MET_OFFICE_SESSION.mount('https://', MET_OFFICE_ADAPTER)
+MET_OFFICE_TIMEOUT = (3.05, 10)
+"""The decoded forecasts for each location are pickled along with the
+response's ETag and Last-Modified headers (or its Date header when neither is
+sent). When the cached or revalidated response is unchanged the forecasts are
+reused rather than decoding the JSON again. Forecasts are pickled as plain
+tuples, so the cache doesn't depend on the module name the script was run
+under, and the version is bumped whenever their fields change.
+"""
+FORECASTS_CACHE_FILE = os.path.join(CACHE_DIR, 'forecasts.pkl')
+FORECASTS_CACHE_VERSION = 3
 """Fullwidth chars unicode characters:
 http://www.fileformat.info/info/unicode/block/halfwidth_and_fullwidth_forms/
 """
@@ -92,6 +150,11 @@ FULLWIDTH_UNICODE = {' ': u"\u3000",
                      'x': u"\uFF58",
                      'y': u"\uFF59",
                      'z': u"\uFF5A"}
+FULLWIDTH_TABLE = str.maketrans(FULLWIDTH_UNICODE)
+"""Fullwidth day of week (MON, TUE, WED etc) indexed by datetime.weekday()
+"""
+WEEKDAY_FULLWIDTH = tuple(day.translate(FULLWIDTH_TABLE) for day in
+                          ('MON', 'TUE', 'WED', 'THU', 'FRI', 'SAT', 'SUN'))
 """Emoticons - unicode smiley faces used for good weather
 http://www.fileformat.info/info/unicode/block/emoticons/list.htm
 """
@@ -105,6 +168,12 @@ http://www.fileformat.info/info/unicode/block/arrows/utf8test.htm
 ARROWS_UNICODE = {'RIGHTWARDS ARROW':         u"\u2192",
                   'RIGHTWARDS PAIRED ARROWS': u"\u21C9",
                   'THREE RIGHTWARDS ARROWS':  u"\u21F6"}
+"""Wind speeds (mph) from which the next arrow in WIND_SPEED_ARROWS is used
+"""
+WIND_SPEED_THRESHOLDS = (10, 20)
+WIND_SPEED_ARROWS = (ARROWS_UNICODE['RIGHTWARDS ARROW'],
+                     ARROWS_UNICODE['RIGHTWARDS PAIRED ARROWS'],
+                     ARROWS_UNICODE['THREE RIGHTWARDS ARROWS'])
 """Degrees Celcius - unicode degrees celcius symbol
 http://www.fileformat.info/info/unicode/char/2103/index.htm
 """
@@ -125,6 +194,8 @@ http://www.fileformat.info/info/unicode/block/cjk_compatibility/list.htm
 """
 MERIDIEM_UNICODE = {'SQUARE AM': u"\u33C2",
                     'SQUARE PM': u"\u33D8"}
+MERIDIEM_BY_HALF_DAY = (MERIDIEM_UNICODE['SQUARE AM'],
+                        MERIDIEM_UNICODE['SQUARE PM'])
 """Met office weather types
 https://www.metoffice.gov.uk/datapoint/support/documentation/code-definitions
 """
@@ -159,6 +230,58 @@ WEATHER_TYPES = {'Clear night':                 0,
                  'Thunder shower (night)':     28,
                  'Thunder shower (day)':       29,
                  'Thunder':                    30}
+"""Met Office weather types shown by each weather unicode symbol
+"""
+WEATHER_TYPES_BY_ICON = {
+    'CRESCENT MOON':            [WEATHER_TYPES['Clear night']],
+    'BLACK SUN WITH RAYS':      [WEATHER_TYPES['Sunny day']],
+    'SUN BEHIND CLOUD':         [WEATHER_TYPES['Partly cloudy (day)']],
+    'CLOUD':                    [WEATHER_TYPES['Partly cloudy (night)'],
+                                 WEATHER_TYPES['Cloudy'],
+                                 WEATHER_TYPES['Overcast']],
+    'FOGGY':                    [WEATHER_TYPES['Mist'],
+                                 WEATHER_TYPES['Fog']],
+    'UMBRELLA WITH RAIN DROPS': range(
+        WEATHER_TYPES['Light rain shower (night)'],
+        WEATHER_TYPES['Hail'] + 1),
+    'SNOWFLAKE':                range(
+        WEATHER_TYPES['Light snow shower (night)'],
+        WEATHER_TYPES['Heavy snow'] + 1),
+    'THUNDER CLOUD AND RAIN':   range(
+        WEATHER_TYPES['Thunder shower (night)'],
+        WEATHER_TYPES['Thunder'] + 1)}
+"""Weather unicode symbol indexed by Met Office weather type, anything not
+listed above (i.e. 'Not used') is shown as a cloud
+"""
+WEATHER_ICON_BY_TYPE = tuple(
+    next((WEATHER_UNICODE[icon]
+          for icon, weather_types in WEATHER_TYPES_BY_ICON.items()
+          if weather_type in weather_types),
+         WEATHER_UNICODE['CLOUD'])
+    for weather_type in range(len(WEATHER_TYPES)))
+"""Met Office weather types that count as nice weather
+"""
+NICE_WEATHER_TYPES = frozenset([WEATHER_TYPES['Clear night'],
+                                WEATHER_TYPES['Sunny day'],
+                                WEATHER_TYPES['Partly cloudy (night)'],
+                                WEATHER_TYPES['Partly cloudy (day)'],
+                                WEATHER_TYPES['Cloudy']])
+"""Each 3 hourly forecast period is an eighth of a day and ends one second
+before the next period starts
+"""
+PERIOD_MINUTES = 24 * 60 // 8
+PERIOD_LENGTH = datetime.timedelta(minutes=PERIOD_MINUTES, seconds=-1)
+
+
+class Forecast(NamedTuple):
+    """A single 3 hourly Met Office forecast"""
+    period: int
+    from_: datetime.datetime
+    to: datetime.datetime
+    weather_type: int
+    temperature_c: int
+    wind_speed_mph: int
+    rain_probability_pc: int
 
 
 def setup_logging():
@@ -177,76 +300,36 @@ def setup_logging():
 
 def string_to_fullwidth(string, rjustlen=0):
     """Translate any string to fullwidth UNICODE characters."""
-    fullwidth_string = ''
-    if rjustlen > 0:
-        string = string.rjust(rjustlen)
-    for char in string:
-        fullwidth_string += FULLWIDTH_UNICODE[char]
-    return fullwidth_string
+    return string.rjust(rjustlen).translate(FULLWIDTH_TABLE)
 
 
 def get_am_pm(time):
     """Get the a.m. or p.m. unicode symbol depending on the time"""
-    if time.hour < 12:
-        return MERIDIEM_UNICODE['SQUARE AM']
-    else:
-        return MERIDIEM_UNICODE['SQUARE PM']
+    return MERIDIEM_BY_HALF_DAY[time.hour >= 12]
 
 
 def get_weather_icon(weather_type):
     """Using the Met Office weather type, get the relevant emoji"""
-    clear_night = [WEATHER_TYPES['Clear night']]
-    sun = [WEATHER_TYPES['Sunny day']]
-    sun_cloud = [WEATHER_TYPES['Partly cloudy (day)']]
-    cloud = [WEATHER_TYPES['Partly cloudy (night)'],
-             WEATHER_TYPES['Cloudy'],
-             WEATHER_TYPES['Overcast']]
-    fog = [WEATHER_TYPES['Mist'],
-           WEATHER_TYPES['Fog']]
-    rain = range(WEATHER_TYPES['Light rain shower (night)'],
-                 WEATHER_TYPES['Hail'])
-    snow = range(WEATHER_TYPES['Light snow shower (night)'],
-                 WEATHER_TYPES['Heavy snow'])
-    thunder = range(WEATHER_TYPES['Thunder shower (night)'],
-                    WEATHER_TYPES['Thunder'])
-    if weather_type in clear_night:
-        return WEATHER_UNICODE['CRESCENT MOON']
-    elif weather_type in sun:
-        return WEATHER_UNICODE['BLACK SUN WITH RAYS']
-    elif weather_type in sun_cloud:
-        return WEATHER_UNICODE['SUN BEHIND CLOUD']
-    elif weather_type in cloud:
-        return WEATHER_UNICODE['CLOUD']
-    elif weather_type in fog:
-        return WEATHER_UNICODE['FOGGY']
-    elif weather_type in rain:
-        return WEATHER_UNICODE['UMBRELLA WITH RAIN DROPS']
-    elif weather_type in snow:
-        return WEATHER_UNICODE['SNOWFLAKE']
-    elif weather_type in thunder:
-        return WEATHER_UNICODE['THUNDER CLOUD AND RAIN']
-    else:
-        return WEATHER_UNICODE['CLOUD']
+    if 0 <= weather_type < len(WEATHER_ICON_BY_TYPE):
+        return WEATHER_ICON_BY_TYPE[weather_type]
+    return WEATHER_UNICODE['CLOUD']
 
 
+@lru_cache(maxsize=128)
 def get_temperature(temperature):
     """Right justify the temperature and add the degress centigrade symbol"""
     return "{}{}".format(string_to_fullwidth(str(temperature), 3),
                          DEGREE_CELSIUS_UNICODE)
 
 
+@lru_cache(maxsize=128)
 def get_wind_speed(speed):
     """From the wind speed calculate the number of arrows to indicate the
     wind strength and then add the actual speed and mph
     """
-    if speed < 10:
-        wind_speed = ARROWS_UNICODE['RIGHTWARDS ARROW']
-    elif speed < 20:
-        wind_speed = ARROWS_UNICODE['RIGHTWARDS PAIRED ARROWS']
-    else:
-        wind_speed = ARROWS_UNICODE['THREE RIGHTWARDS ARROWS']
-    wind_speed += string_to_fullwidth(str(speed), 2) + 'mph'
-    return wind_speed
+    arrow = WIND_SPEED_ARROWS[bisect.bisect_right(WIND_SPEED_THRESHOLDS,
+                                                  speed)]
+    return arrow + string_to_fullwidth(str(speed), 2) + 'mph'
 
 
 def calc_nice_day_emoticon(current_index, forecasts):
@@ -254,18 +337,13 @@ def calc_nice_day_emoticon(current_index, forecasts):
     the previous three forecasts (so a total of 12 hours) to see if the weather
     was good (no rain, low wind)
     """
-    nice_weather_types = [WEATHER_TYPES['Clear night'],
-                          WEATHER_TYPES['Sunny day'],
-                          WEATHER_TYPES['Partly cloudy (night)'],
-                          WEATHER_TYPES['Partly cloudy (day)'],
-                          WEATHER_TYPES['Cloudy']]
     recent_forecasts = forecasts[max(current_index - 3, 0):current_index + 1]
     for i, forecast in enumerate(reversed(recent_forecasts)):
         # Nice weather is a clear or cloudy day with a windspeed <= 15 mph
         # and change of rain <= 20%
-        if not (forecast['weather_type'] in nice_weather_types and
-                forecast['wind_speed_mph'] <= 15 and
-                forecast['rain_probability_pc'] <= 20):
+        if not (forecast.weather_type in NICE_WEATHER_TYPES and
+                forecast.wind_speed_mph <= 15 and
+                forecast.rain_probability_pc <= 20):
             if i <= 1:
                 return EMOTICONS_UNICODE['LOUDLY CRYING FACE']
             else:
@@ -275,6 +353,45 @@ def calc_nice_day_emoticon(current_index, forecasts):
     return EMOTICONS_UNICODE['SMILEY FACE WITH OPEN MOUTH']
 
 
+def load_cached_forecasts():
+    """Load the previously decoded forecasts, keyed by location ID. The cache
+    is only an optimisation so anything wrong with it means starting afresh
+    """
+    try:
+        with open(FORECASTS_CACHE_FILE, 'rb') as cache_file:
+            cache = pickle.load(cache_file)
+        if cache['version'] != FORECASTS_CACHE_VERSION:
+            return {}
+        return cache['locations']
+    except FileNotFoundError:
+        return {}
+    except Exception:
+        logging.warning('Ignoring unreadable forecasts cache {}'
+                        .format(FORECASTS_CACHE_FILE), exc_info=True)
+        return {}
+
+
+def save_cached_forecasts(locations):
+    """Save the decoded forecasts, keyed by location ID. The cache is written
+    to a temporary file first so an interrupted run can't leave it truncated
+    """
+    temp_file_name = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        temp_file, temp_file_name = tempfile.mkstemp(dir=CACHE_DIR,
+                                                     suffix='.tmp')
+        with os.fdopen(temp_file, 'wb') as cache_file:
+            pickle.dump({'version': FORECASTS_CACHE_VERSION,
+                         'locations': locations}, cache_file)
+        os.replace(temp_file_name, FORECASTS_CACHE_FILE)
+    except Exception:
+        logging.warning('Unable to cache forecasts in {}'
+                        .format(FORECASTS_CACHE_FILE), exc_info=True)
+        if temp_file_name is not None:
+            with contextlib.suppress(OSError):
+                os.remove(temp_file_name)
+
+
 def get_met_office_3hourly_forecast(location_id):
     """Get the Met Office 3 hourly forecast using the location ID"""
     logging.info('Reading 3 hourly weather forecast for location ID {}'
@@ -282,34 +399,57 @@ def get_met_office_3hourly_forecast(location_id):
     url = ('http://datapoint.metoffice.gov.uk/' +
            'public/data/val/wxfcs/all/json/' +
            location_id)
-    response = requests.get(url, params={'res': '3hourly',
-                                         'key': MET_OFFICE_API_KEY})
+    response = MET_OFFICE_SESSION.get(url,
+                                      params={'res': '3hourly',
+                                              'key': MET_OFFICE_API_KEY},
+                                      timeout=MET_OFFICE_TIMEOUT)
     response.raise_for_status()
-    json_response = response.json()
+    # A revalidated (304) response gets a new Date header merged into it, so
+    # Date is only used when there is no ETag or Last-Modified to go on
+    validators = (response.headers.get('ETag'),
+                  response.headers.get('Last-Modified'))
+    if validators == (None, None):
+        validators = (response.headers.get('Date'),)
+    cached_forecasts = load_cached_forecasts()
+    if location_id in cached_forecasts:
+        cached_validators, location_name, rows = cached_forecasts[location_id]
+        if cached_validators == validators:
+            forecasts = [Forecast(*row) for row in rows]
+            logging.info('Forecast unchanged, reusing {} forecasts for {}'
+                         .format(len(forecasts), location_name))
+            return location_name, forecasts
+    # The body is decoded in one go rather than streamed: the cached session
+    # has already read all of it to store it, and only the Location name and
+    # Period/Rep values are picked out into Forecasts below
+    json_response = json_loads(response.content)
     location_name = json_response['SiteRep']['DV']['Location']['name']
     forecasts = []
     for period in json_response['SiteRep']['DV']['Location']['Period']:
-        period_date = datetime.datetime.strptime(period['value'], '%Y-%m-%dZ')
+        # The period date is in the form 2019-03-10Z
+        period_date = datetime.datetime.fromisoformat(period['value'][:-1])
         for rep in period['Rep']:
-            forecast = dict()
-            forecast['period'] = int(rep['$']) / (24 * 60 / 8) + 1
-            forecast['from'] = (period_date +
-                                datetime.timedelta(minutes=int(rep['$'])))
-            forecast['to'] = (forecast['from'] +
-                              datetime.timedelta(minutes=(24 * 60 / 8),
-                                                 seconds=-1))
-            forecast['weather_type'] = int(rep['W'])
-            forecast['temperature_c'] = int(rep['T'])
-            forecast['wind_speed_mph'] = int(rep['S'])
-            forecast['rain_probability_pc'] = int(rep['Pp'])
-            forecasts.append(forecast)
+            # Minutes after midnight the forecast period starts
+            offset = int(rep['$'])
+            from_ = period_date + datetime.timedelta(minutes=offset)
+            forecasts.append(Forecast(
+                period=offset // PERIOD_MINUTES + 1,
+                from_=from_,
+                to=from_ + PERIOD_LENGTH,
+                weather_type=int(rep['W']),
+                temperature_c=int(rep['T']),
+                wind_speed_mph=int(rep['S']),
+                rain_probability_pc=int(rep['Pp'])))
     logging.info('{} forecasts read over {} days for {} from {} to {}'
                  .format(len(forecasts),
                          len(json_response['SiteRep']['DV']['Location']
                                           ['Period']),
                          location_name,
-                         forecasts[0]['from'].strftime('%d/%m/%Y %H:%M'),
-                         forecasts[-1]['to'].strftime('%d/%m/%Y %H:%M')))
+                         forecasts[0].from_.strftime('%d/%m/%Y %H:%M'),
+                         forecasts[-1].to.strftime('%d/%m/%Y %H:%M')))
+    cached_forecasts[location_id] = (validators, location_name,
+                                     [tuple(forecast)
+                                      for forecast in forecasts])
+    save_cached_forecasts(cached_forecasts)
     return location_name, forecasts
 
 
@@ -322,32 +462,41 @@ def main():
         logging.error('Please enter a Met Office location ID as the first'
                       'argument')
         return
-    location_name, forecasts = get_met_office_3hourly_forecast(sys.argv[1])
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Connecting to Pushbullet makes its own request, so do it while the
+        # forecast is being read
+        pushbullet_future = executor.submit(Pushbullet, PUSHBULLET_API_KEY)
+        location_name, forecasts = get_met_office_3hourly_forecast(
+            sys.argv[1])
     try:
-        body = ''
-        for i, forecast in enumerate(forecasts):
-            # Only send a forecast for periods 4 (9am-12pm) and 5 (12pm-3pm)
-            if forecast['period'] == 4 or forecast['period'] == 5:
-                logging.info('Calculating new forecast for {}'
-                             .format(forecast['from'].
-                                     strftime('%a %d/%m/%Y %H:%M')))
-                if body != '':
-                    body += '\n'
-                # Day of week (MON, TUE, WED etc)
-                body += string_to_fullwidth(forecast['from']
-                                            .strftime('%a').upper())
-                # am or pm
-                body += get_am_pm(forecast['from'].time())
-                # Nice day emoticon
-                body += calc_nice_day_emoticon(i, forecasts)
-                # weather icon
-                body += get_weather_icon(forecast['weather_type'])
-                # temprature in C
-                body += get_temperature(forecast['temperature_c'])
-                # wind speed in mph
-                body += get_wind_speed(forecast['wind_speed_mph'])
+        parts = []
+        # Only send a forecast for periods 4 (9am-12pm) and 5 (12pm-3pm),
+        # stopping once MAX_WEATHER_TARGETS have been found
+        targets = itertools.islice(((i, forecast)
+                                    for i, forecast in enumerate(forecasts)
+                                    if forecast.period in (4, 5)),
+                                   MAX_WEATHER_TARGETS)
+        for i, forecast in targets:
+            logging.info('Calculating new forecast for {}'
+                         .format(forecast.from_.
+                                 strftime('%a %d/%m/%Y %H:%M')))
+            if parts:
+                parts.append('\n')
+            # Day of week (MON, TUE, WED etc)
+            parts.append(WEEKDAY_FULLWIDTH[forecast.from_.weekday()])
+            # am or pm
+            parts.append(get_am_pm(forecast.from_.time()))
+            # Nice day emoticon
+            parts.append(calc_nice_day_emoticon(i, forecasts))
+            # weather icon
+            parts.append(get_weather_icon(forecast.weather_type))
+            # temprature in C
+            parts.append(get_temperature(forecast.temperature_c))
+            # wind speed in mph
+            parts.append(get_wind_speed(forecast.wind_speed_mph))
+        body = ''.join(parts)
         # Send this message to pushbullet
-        pb = Pushbullet(PUSHBULLET_API_KEY)
+        pb = pushbullet_future.result()
         pb.push_note('Weather for {}'.format(location_name), body)
         logging.info('Forecast sent to pushbullet')
     except: